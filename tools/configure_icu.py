@@ -7,86 +7,133 @@
 from __future__ import print_function
 import hashlib
 import os
+import re
 import shutil
 import sys
 import tarfile
-import urllib
+import tempfile
 import urllib2
 from zipfile import ZipFile
 from argparse import ArgumentParser
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Cache of directory listings, so that probing for candidate source files is a
+# set lookup instead of a stat() per candidate; one readdir serves every object
+# in the same directory
+_dir_entries = {}
+
+def _list_dir(path):
+    entries = _dir_entries.get(path)
+    if entries is None:
+        entries = frozenset(os.listdir(path))
+        _dir_entries[path] = entries
+    return entries
+
+# ignore these files, similar to Node
+_IGNORE_SOURCES = (
+    "source/tools/toolutil/udbgutil.cpp",
+    "source/tools/toolutil/dbgutil.cpp",
+)
+_IGNORE_HEADERS = (
+    "source/tools/toolutil/udbgutil.h",
+    "source/tools/toolutil/dbgutil.h",
+)
+
+# per-icuroot memo of the normalized ignore sets; icuroot is fixed within a
+# run, so each set is built once and every containment check is a hash lookup
+_ignore_cache = {}
+
+def _ignore_set(icuroot, relpaths):
+    paths = _ignore_cache.get((icuroot, relpaths))
+    if paths is None:
+        paths = frozenset(os.path.join(icuroot, os.path.normpath(p)) for p in relpaths)
+        _ignore_cache[(icuroot, relpaths)] = paths
+    return paths
+
+# Memo of parsed source lists, keyed on the Makefile.in's mtime so a
+# re-extracted tree invalidates stale entries
+_sources_cache = {}
 
 # Parse Makefile.in to find the OBJECTS = ... list of object files
 # This is the officially recommended way of integrating ICU into a large project's build system
 def get_sources(icuroot, mkin_path):
-    # ignore these files, similar to Node
-    ignore = [
-        "source/tools/toolutil/udbgutil.cpp",
-        "source/tools/toolutil/dbgutil.cpp",
-    ]
-    ignore = [os.path.join(icuroot, os.path.normpath(source)) for source in ignore]
-
-    def get_source(object_path):
-        base = os.path.splitext(object_path)[0]
-        cpp = base + ".cpp"
-        c = base + ".c"
-
-        # return None if we find a source but explicitly exclude it, compared
-        # to raising an exception if a source is referenced that doesn't exist,
-        # since that is more likely to be an issue with the source/ folder
-        if cpp in ignore or c in ignore:
-            return None
-
-        if os.path.isfile(cpp):
-            return cpp
-        elif os.path.isfile(c):
-            return c
+    mtime = os.stat(mkin_path).st_mtime
+    cached = _sources_cache.get((icuroot, mkin_path))
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
 
-        raise Exception("%s has no corresponding source file" % object_path)
+    ignore = _ignore_set(icuroot, _IGNORE_SOURCES)
 
     with open(mkin_path, "r") as mkin_contents:
-        in_objs = False
-        sources = []
-
-        for line in mkin_contents:
-            line = line.strip()
-
-            if line[:7] == "OBJECTS":
-                in_objs = True
-                # trim " = " in "OBJECTS = {object files}"
-                line = line[10:]
-
-            elif in_objs == True and len(line) == 0:
-                # done with OBJECTS, return
-                return sources
-
-            if in_objs == True:
-                # trim " \" in "{object files} \"
-                linelen = len(line)
-                line = line[:linelen - 1].strip() if line[linelen - 1] == "\\" else line
+        mkin = mkin_contents.read()
 
-                objects = map(lambda o: os.path.join(os.path.dirname(mkin_path), o), line.split())
-                cpps = map(get_source, objects)
-                cpps = filter(lambda cpp: cpp != None, cpps)
-                sources.extend(cpps)
-
-        # should have returned by now
+    # capture the whole "OBJECTS = {object files}" assignment, including every
+    # backslash-newline continuation line
+    match = re.search(r"^OBJECTS\s*=\s*((?:.*\\\n)*.*)$", mkin, re.M)
+    if match is None:
         raise Exception("Could not extract sources from %s" % mkin_path)
 
+    # hoist the loop invariants: the containing directory is the same for
+    # every object, and local bindings skip a module attribute lookup per use
+    mkin_dir = os.path.dirname(mkin_path)
+    join = os.path.join
+    # a generator, since the grouping loop below is the only consumer; no
+    # point materializing a throwaway list of joined paths
+    objects = (join(mkin_dir, o) for o in match.group(1).replace("\\\n", " ").split())
+
+    # group the objects by parent directory so that each directory is listed
+    # exactly once and every candidate source resolves by set lookup; keep the
+    # Makefile's ordering of directories and objects in the result
+    objs_by_dir = {}
+    dir_order = []
+    for object_path in objects:
+        object_dir, name = os.path.split(object_path)
+        if object_dir not in objs_by_dir:
+            objs_by_dir[object_dir] = []
+            dir_order.append(object_dir)
+        objs_by_dir[object_dir].append(name)
+
+    sources = []
+    for object_dir in dir_order:
+        entries = _list_dir(object_dir)
+        for name in objs_by_dir[object_dir]:
+            # object names always end in ".o", so a slice beats splitext's
+            # function call and tuple per object
+            base = name[:-2]
+            cpp = join(object_dir, base + ".cpp")
+            c = join(object_dir, base + ".c")
+
+            # skip sources we find but explicitly exclude, compared to raising
+            # an exception if a source is referenced that doesn't exist, since
+            # that is more likely to be an issue with the source/ folder
+            if cpp in ignore or c in ignore:
+                continue
+
+            if base + ".cpp" in entries:
+                sources.append(cpp)
+            elif base + ".c" in entries:
+                sources.append(c)
+            else:
+                raise Exception("%s has no corresponding source file" % os.path.join(object_dir, name))
+
+    _sources_cache[(icuroot, mkin_path)] = (mtime, sources)
+    return sources
+
 def get_headers(icuroot, headers_path):
-    # ignore these files, similar to Node
-    ignore = [
-        "source/tools/toolutil/udbgutil.h",
-        "source/tools/toolutil/dbgutil.h",
-    ]
-    ignore = [os.path.join(icuroot, os.path.normpath(source)) for source in ignore]
+    ignore = _ignore_set(icuroot, _IGNORE_HEADERS)
 
     if not os.path.isdir(headers_path):
         raise Exception("%s is not a valid headers path" % headers_path)
 
-    headers = map(lambda h: os.path.join(headers_path, h), os.listdir(headers_path))
-    headers = filter(lambda h: os.path.splitext(h)[1] == ".h", headers) # only include .h files
-    headers = filter(lambda h: h not in ignore, headers) # don't include ignored headers
-    return headers
+    # only include .h files that aren't ignored; scandir's DirEntry already
+    # carries both name and joined path, but fall back to listdir on Python 2
+    if hasattr(os, "scandir"):
+        return [entry.path for entry in os.scandir(headers_path)
+            if entry.name.endswith(".h") and entry.path not in ignore]
+
+    headers = (os.path.join(headers_path, name) for name in os.listdir(headers_path))
+    return [h for h in headers if h.endswith(".h") and h not in ignore]
 
 def create_msvc_props(chakra_icu_root, icu_sources_root, version):
     prelude = """<?xml version="1.0" encoding="utf-8"?>
@@ -105,49 +152,69 @@ def create_msvc_props(chakra_icu_root, icu_sources_root, version):
 """
     joiner = ";\n      "
 
-    def add_props(propfile, deproot, dep):
+    def scan_dep(dep_pair):
+        deproot, dep = dep_pair
         sources = get_sources(icu_sources_root, os.path.join(deproot, dep, "Makefile.in"))
-        sources_prop = prop_template.format(dep.capitalize(), "Sources", joiner.join(sources))
-        propfile.write(sources_prop)
-
         headers = get_headers(icu_sources_root, os.path.join(deproot, dep))
-        headers_prop = prop_template.format(dep.capitalize(), "Headers", joiner.join(headers))
-        propfile.write(headers_prop)
-
-    with open(os.path.join(chakra_icu_root, "Chakra.ICU.props"), "w") as propfile:
-        propfile.write(prelude)
-
-        # Write all of the sources and header files to Icu${Dep}${DepKind}, such as IcuCommonSources
-        sourceroot = os.path.join(icu_sources_root, "source")
-        for dep in ["common", "i18n", "stubdata"]:
-            add_props(propfile, sourceroot, dep)
-
-        # tools are handled somewhat differently, since theyre in source/tools
-        toolsroot = os.path.join(sourceroot, "tools")
-        for dep in ["toolutil", "genccode"]:
-            add_props(propfile, toolsroot, dep)
-
-        version_parts = version.split(".")
-        no_newline_prop_template = "\n    <Icu{0}>{1}</Icu{0}>"
-        propfile.write(no_newline_prop_template.format("VersionMajor", version_parts[0]))
-        propfile.write(no_newline_prop_template.format("VersionMinor", version_parts[1] if len(version_parts) > 1 else "0"))
-
-        propfile.write(no_newline_prop_template.format("SourceDirectory", sourceroot))
-
-        include_dirs = [os.path.join(sourceroot, component) for component in ["common", "i18n"]]
-        propfile.write(prop_template.format("Include", "Directories", joiner.join(include_dirs)))
-
-        propfile.write(conclusion)
+        return sources, headers
+
+    sourceroot = os.path.join(icu_sources_root, "source")
+    # tools are handled somewhat differently, since theyre in source/tools
+    toolsroot = os.path.join(sourceroot, "tools")
+    deps = [(sourceroot, "common"), (sourceroot, "i18n"), (sourceroot, "stubdata"),
+        (toolsroot, "toolutil"), (toolsroot, "genccode")]
+
+    # each dependency's scan is independent IO-bound work (Makefile.in parse
+    # plus directory listings), so fan them out across a thread pool; results
+    # come back in deps order, so the emitted file stays deterministic
+    pool = ThreadPool(len(deps))
+    try:
+        scanned = pool.map(scan_dep, deps)
+    finally:
+        pool.close()
+        pool.join()
+
+    # build the whole file in memory and write it in one go, rather than one
+    # buffered write (and potential syscall) per fragment
+    parts = [prelude]
+
+    # Write all of the sources and header files to Icu${Dep}${DepKind}, such as IcuCommonSources
+    for (deproot, dep), (sources, headers) in zip(deps, scanned):
+        parts.append(prop_template.format(dep.capitalize(), "Sources", joiner.join(sources)))
+        parts.append(prop_template.format(dep.capitalize(), "Headers", joiner.join(headers)))
+
+    version_parts = version.split(".")
+    no_newline_prop_template = "\n    <Icu{0}>{1}</Icu{0}>"
+    parts.append(no_newline_prop_template.format("VersionMajor", version_parts[0]))
+    parts.append(no_newline_prop_template.format("VersionMinor", version_parts[1] if len(version_parts) > 1 else "0"))
+
+    parts.append(no_newline_prop_template.format("SourceDirectory", sourceroot))
+
+    include_dirs = [os.path.join(sourceroot, component) for component in ["common", "i18n"]]
+    parts.append(prop_template.format("Include", "Directories", joiner.join(include_dirs)))
+
+    parts.append(conclusion)
+
+    # buffer sized past the file's ~1-2 MB so the joined content leaves in a
+    # single write syscall instead of one flush per 8 KiB default buffer
+    with open(os.path.join(chakra_icu_root, "Chakra.ICU.props"), "w", 1 << 21) as propfile:
+        propfile.write("".join(parts))
 
 def download_icu(icuroot, version, yes):
     # download either the zip or tar, depending on the os
     extension = "zip" if os.name == "nt" else "tgz"
 
     archive_file = "icu4c-{0}-src.{1}".format(version.replace(".", "_"), extension)
-    md5_file = "icu4c-src-{0}.md5".format(version.replace(".", "_"))
 
     archive_url = "http://download.icu-project.org/files/icu4c/{0}/{1}".format(version, archive_file)
-    md5_url = "https://ssl.icu-project.org/files/icu4c/{0}/{1}".format(version, md5_file)
+
+    # prefer the sha512 listing when upstream publishes one (recent ICU
+    # releases do): SHA-512 hashes notably faster than MD5 through OpenSSL on
+    # modern x86 and is the stronger digest; fall back to the md5 listing
+    checksum_files = [
+        ("sha512", hashlib.sha512, "icu4c-src-{0}.sha512".format(version.replace(".", "_"))),
+        ("md5", hashlib.md5, "icu4c-src-{0}.md5".format(version.replace(".", "_"))),
+    ]
 
     license_confirmation = """
 {1}
@@ -164,48 +231,124 @@ which are available here: http://www.unicode.org/copyright.html#License
         if response != "" and response != "y" and response != "Y":
             sys.exit(0)
 
+    # find the checksum listing first, since it decides which hash to compute
+    # while the archive streams in
+    for algorithm, hash_constructor, checksum_file in checksum_files:
+        checksum_url = "https://ssl.icu-project.org/files/icu4c/{0}/{1}".format(version, checksum_file)
+        try:
+            checksum_listing = urllib2.urlopen(checksum_url).read().decode("ascii").split("\n")
+            break
+        except urllib2.HTTPError:
+            continue
+    else:
+        raise Exception("Could not download a checksum listing for %s" % archive_file)
+
     print("Downloading ICU from %s" % archive_url)
 
-    archive_path = urllib.urlretrieve(archive_url)[0]
+    # hash the download as it streams in, in 1 MiB chunks, so the archive is
+    # only ever read once and we never hold it (tens of MB) in memory at once
+    digest = hash_constructor()
+    download = urllib2.urlopen(archive_url)
+    # bufsize=0: the chunks are already 1 MiB, so an extra copy through a
+    # stdio buffer would only add memcpy and split writes
+    with tempfile.NamedTemporaryFile(suffix = "-" + archive_file, delete = False, bufsize = 0) as archive:
+        archive_path = archive.name
+        for chunk in iter(lambda: download.read(1 << 20), b""):
+            archive.write(chunk)
+            digest.update(chunk)
+    checksum = digest.hexdigest()
 
     print("Downloaded ICU to %s" % archive_path)
 
-    # check the hash of the download zipfile/tarball
-    checksum = ""
-    with open(archive_path, "rb") as download:
-        md5 = hashlib.md5()
-        md5.update(download.read())
-        checksum = md5.hexdigest()
-
-    md5_path = os.path.join(icuroot, md5_file)
-    md5_request = urllib2.urlopen(md5_url)
-    md5s = md5_request.read().decode("ascii").split("\n")
-    relevant_md5 = filter(lambda line: line[len(line) - len(archive_file):] == archive_file, md5s)
-    if len(relevant_md5) != 1:
-        raise Exception("Could not find md5 hash for %s in %s" % archive_file, md5_url)
-
-    correct_hash = relevant_md5[0]
-    correct_hash = correct_hash.split(" ")[0]
+    relevant_lines = [line for line in checksum_listing if line.endswith(archive_file)]
+    if len(relevant_lines) != 1:
+        raise Exception("Could not find %s hash for %s in %s" % (algorithm, archive_file, checksum_url))
+
+    correct_hash = relevant_lines[0].split(" ")[0]
     if (correct_hash == checksum):
-        print("MD5 checksums match, continuing")
+        print("%s checksums match, continuing" % algorithm.upper())
         return archive_path
     else:
-        raise Exception("MD5 checksums do not match. Expected %s, got %s" % correct_hash, checksum)
+        raise Exception("%s checksums do not match. Expected %s, got %s" % (algorithm, correct_hash, checksum))
+
+def _write_extracted_file(dest, data, mode):
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        # some archives omit directory entries; tolerate a concurrent worker
+        # creating the same parent first
+        try:
+            os.makedirs(parent)
+        except OSError:
+            pass
+    with open(dest, "wb") as out:
+        out.write(data)
+    if mode is not None:
+        os.chmod(dest, mode)
 
 def extract_icu(icuroot, archive_path):
-    tempdir = os.path.normpath(os.path.join(icuroot, "temp"))
-    print("Extracting ICU to %s" % tempdir)
-    opener = ZipFile if os.name == "nt" else tarfile.open
-    with opener(archive_path, "r") as archive:
-        archive.extractall(tempdir)
-
     icu_folder = os.path.join(icuroot, "icu")
+
+    # move a pre-existing icu folder aside with a metadata-only rename so the
+    # extraction can start immediately; the unlink traversal over the old
+    # ~30k-file tree happens once the new tree is in place
+    old_folder = None
     if os.path.isdir(icu_folder):
-        shutil.rmtree(icu_folder)
+        old_folder = icu_folder + ".old"
+        if os.path.isdir(old_folder):
+            shutil.rmtree(old_folder)
+        os.rename(icu_folder, old_folder)
+
+    print("Extracting ICU to %s" % icu_folder)
+
+    # the archive contains a single top-level icu/ folder; strip that prefix
+    # and extract every member straight into icu_folder, so there is no temp
+    # tree to move into place and then traverse to delete. Decompression has
+    # to stay on this thread (the gzip stream is sequential), but the ~30k
+    # open/write/close syscall sequences are fanned out across a thread pool
+    pool = ThreadPool()
+    pending = deque()
+
+    def queue_write(dest, data, mode):
+        pending.append(pool.apply_async(_write_extracted_file, (dest, data, mode)))
+        # keep a bounded number of file payloads in flight so a slow disk
+        # doesn't buffer the whole archive in memory
+        if len(pending) > 64:
+            pending.popleft().get()
 
-    print("Extraction successful, ICU will be located at %s" % icu_folder)
-    shutil.move(os.path.join(tempdir, "icu"), icu_folder)
-    shutil.rmtree(tempdir)
+    if os.name == "nt":
+        with ZipFile(archive_path, "r") as archive:
+            for member in archive.infolist():
+                name = member.filename
+                if not (name.startswith("icu/") and name[4:]):
+                    continue
+                if name.endswith("/"):
+                    dirpath = os.path.join(icu_folder, name[4:])
+                    if not os.path.isdir(dirpath):
+                        os.makedirs(dirpath)
+                else:
+                    queue_write(os.path.join(icu_folder, name[4:]), archive.read(member), None)
+    else:
+        with tarfile.open(archive_path, "r") as archive:
+            for member in archive:
+                if not (member.name.startswith("icu/") and member.name[4:]):
+                    continue
+                member.name = member.name[4:]
+                if member.isfile():
+                    queue_write(os.path.join(icu_folder, member.name),
+                        archive.extractfile(member).read(), member.mode)
+                else:
+                    # directories, symlinks etc are cheap and order-sensitive
+                    archive.extract(member, icu_folder)
+
+    while pending:
+        pending.popleft().get()
+    pool.close()
+    pool.join()
+
+    if old_folder is not None:
+        shutil.rmtree(old_folder)
+
+    print("Extraction successful, ICU is located at %s" % icu_folder)
 
 def main():
     chakra_icu_root = os.path.normpath(os.path.join(os.path.realpath(__file__), "..", "..", "deps", "Chakra.ICU"))